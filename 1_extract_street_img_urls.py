@@ -1,12 +1,18 @@
 import os
-import requests
+import asyncio
+import argparse
+import diskcache
+import httpx
+from aiolimiter import AsyncLimiter
+import orjson
 import mercantile
+import numpy as np
 from datetime import datetime
-from vt2geojson.tools import vt_bytes_to_geojson
+from mapbox_vector_tile import decode as mvt_decode
 from dotenv import load_dotenv
 from tqdm import tqdm
 import csv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 
 load_dotenv()
 # Mapillary API access token
@@ -30,42 +36,144 @@ end_ms   = int(END_DATE.timestamp()   * 1000)
 # Output CSV
 OUTFILE = "dc_mapillary_image_data.csv"
 
-# Create a function to fetch the Mapillary vector tile and decode it to GeoJSON
-def fetch_tile_geojson(x, y, z):
+# HTTP/2 client settings: concurrent requests to the same host are multiplexed
+# as streams over a few pooled connections instead of one socket per request
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+HTTP_TIMEOUT = httpx.Timeout(10, pool=None)  # queued streams wait for a free slot
+MAX_RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Token bucket shared by every Mapillary request, sized below the API quota so requests
+# are paced instead of bouncing off 429s
+RATE_LIMIT = 20  # requests per second
+limiter = AsyncLimiter(RATE_LIMIT, 1.0)
+
+# Max tiles decoded / looked up at once (each tile issues its own batched image lookups)
+MAX_CONCURRENT_TILES = 32
+
+# Image ids per Graph API lookup request
+GRAPH_BATCH_SIZE = 50
+
+# On-disk cache of image id -> thumbnail url shared across runs; thumb urls are signed
+# and expire, so entries are only trusted for a week
+URL_CACHE_DIR = ".mapillary_url_cache"
+URL_CACHE_TTL = 7 * 24 * 3600
+url_cache = diskcache.Cache(URL_CACHE_DIR)
+read_url_cache = True  # --no-cache: skip lookups and refresh entries from the API
+
+def retry_delay(r, attempt):
+    """Seconds to wait before retrying: the server's Retry-After hint, else exponential backoff."""
+    hint = r.headers.get("Retry-After", "")
+    return float(hint) if hint.isdigit() else BACKOFF * 2 ** attempt
+
+async def get_with_retry(client, url, params=None):
+    """Rate-limited GET, retrying 429 / transient 5xx responses and connection errors."""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with limiter:
+                r = await client.get(url, params=params)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(BACKOFF * 2 ** attempt)
+            continue
+        if r.status_code not in RETRY_STATUS or attempt == MAX_RETRIES:
+            r.raise_for_status()
+            return r
+        await asyncio.sleep(retry_delay(r, attempt))
+
+# Fetch the raw bytes of a Mapillary vector tile (decoded in a worker process)
+async def fetch_tile_bytes(client, x, y, z):
     url = (
         f"https://tiles.mapillary.com/maps/vtp/mly1_public/2/"
         f"{z}/{x}/{y}?access_token={ACCESS_TOKEN}"
     )
-    r = requests.get(url)
-    r.raise_for_status()
-    return vt_bytes_to_geojson(r.content, x, y, z, layer="image")
-
-def fetch_image_url(image_id):
-    endpoint = f"https://graph.mapillary.com/{image_id}"
-    params = {
-        "fields": "thumb_2048_url",
-        "access_token": ACCESS_TOKEN
-    }
-    r = requests.get(endpoint, params=params)
-    r.raise_for_status()
-    return r.json().get("thumb_2048_url")
-
-def process_tile(tile):
+    r = await get_with_retry(client, url)
+    return r.content
+
+def tile_is_fully_inside(tile, west, south, east, north):
+    """True when the whole tile lies inside the bbox, so its features need no bbox check."""
+    b = mercantile.bounds(tile)
+    return west <= b.west and b.east <= east and south <= b.south and b.north <= north
+
+def tile_to_lonlat(px, py, tile, extent):
+    """Vectorized tile-local (y down) coordinates -> WGS84 lon/lat."""
+    n = 2 ** tile.z
+    lon = (tile.x + px / extent) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (tile.y + py / extent) / n))))
+    return lon, lat
+
+def decode_and_filter(raw, x, y, z, needs_check):
+    """
+    Decode a tile's image layer and keep the features passing the bbox / date / id filter.
+    CPU-bound, so it runs in the process pool. Returns (id, captured_at, lon, lat, tile_url).
+    """
+    tile = mercantile.Tile(x, y, z)
+    layer = mvt_decode(raw, default_options={"y_coord_down": True}).get("image", {})
+    feats, extent = layer.get("features", []), layer.get("extent", 4096)
+
+    # Bbox / date / id filter in one vectorized pass over the tile's features
+    coords = np.fromiter((c for f in feats for c in f["geometry"]["coordinates"]),
+                         dtype=np.float64, count=2 * len(feats)).reshape(-1, 2)
+    lon, lat = tile_to_lonlat(coords[:, 0], coords[:, 1], tile, extent)
+    caps = np.fromiter((f["properties"].get("captured_at", 0) for f in feats),
+                       dtype=np.int64, count=len(feats))
+    has_id = np.fromiter((bool(f["properties"].get("id")) for f in feats),
+                         dtype=bool, count=len(feats))
+    keep = (caps >= start_ms) & (caps <= end_ms) & has_id
+    if needs_check:  # edge tile: drop features outside the bbox
+        keep &= (lon >= WEST) & (lon <= EAST) & (lat >= SOUTH) & (lat <= NORTH)
+
+    candidates = []
+    for i in np.flatnonzero(keep):
+        props = feats[i]["properties"]
+        cap_at = props["captured_at"]
+        img_id = props["id"]
+        # Use the thumbnail url carried by the tile itself when available
+        tile_url = props.get("thumb_2048_url") or props.get("thumb_1024_url")
+        candidates.append((img_id, cap_at, float(lon[i]), float(lat[i]), tile_url))
+    return candidates
+
+async def fetch_image_urls_batch(client, image_ids):
+    """Look up thumb_2048_url for many images, GRAPH_BATCH_SIZE ids per request."""
+    urls = {}
+    if read_url_cache:
+        for img_id in image_ids:
+            cached = url_cache.get(str(img_id))
+            if cached is not None:
+                urls[str(img_id)] = cached
+        image_ids = [i for i in image_ids if str(i) not in urls]
+
+    chunks = [image_ids[i:i + GRAPH_BATCH_SIZE]
+              for i in range(0, len(image_ids), GRAPH_BATCH_SIZE)]
+    responses = await asyncio.gather(*(
+        get_with_retry(client, "https://graph.mapillary.com/images", params={
+            "image_ids": ",".join(str(i) for i in chunk),
+            "fields": "id,thumb_2048_url",
+            "access_token": ACCESS_TOKEN,
+        })
+        for chunk in chunks
+    ))
+    for r in responses:
+        for item in orjson.loads(r.content).get("data", []):
+            url = item.get("thumb_2048_url")
+            urls[str(item["id"])] = url
+            if url:
+                url_cache.set(str(item["id"]), url, expire=URL_CACHE_TTL)
+    return urls
+
+async def process_tile(client, process_pool, tile, download, needs_check=True):
     recs = []
     try:
-        geojson = fetch_tile_geojson(tile.x, tile.y, tile.z)
-        for feat in geojson["features"]:
-            lon, lat = feat["geometry"]["coordinates"]
-            if not (WEST <= lon <= EAST and SOUTH <= lat <= NORTH):
-                continue
-            props = feat["properties"]
-            cap_at = props.get("captured_at", 0)
-            if cap_at < start_ms or cap_at > end_ms:
-                continue
-            img_id = props.get("id")
-            if not img_id:
-                continue
-            img_url = fetch_image_url(img_id)
+        raw = await download  # started up front in main()
+        candidates = await asyncio.get_running_loop().run_in_executor(
+            process_pool, decode_and_filter, raw, tile.x, tile.y, tile.z, needs_check)
+
+        # Only images without a url in the tile need a (batched) Graph API lookup
+        img_urls = await fetch_image_urls_batch(client, [c[0] for c in candidates if not c[4]])
+        for img_id, cap_at, lon, lat, tile_url in candidates:
+            img_url = tile_url or img_urls.get(str(img_id))
             if img_url:
                 recs.append((img_id, cap_at, lon, lat, img_url))
     except Exception as e:
@@ -75,19 +183,31 @@ def process_tile(tile):
 
 # MAIN WORKFLOW
 
-def main():
+async def main():
     records = []
     tiles = list(mercantile.tiles(WEST, SOUTH, EAST, NORTH, 14))
-    
-    max_workers = min(32, (os.cpu_count() or 1) * 5)
+    interior = {t for t in tiles if tile_is_fully_inside(t, WEST, SOUTH, EAST, NORTH)}
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_tile = {executor.submit(process_tile, t): t for t in tiles}
-        for future in tqdm(as_completed(future_to_tile),
-                           total=len(future_to_tile),
-                           desc="Processing tiles",
-                           unit="tile"):
-            records.extend(future.result())
+    tile_slots = asyncio.Semaphore(MAX_CONCURRENT_TILES)
+
+    # Tile decoding is CPU-bound: run it in worker processes, keep the I/O on the event loop
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as process_pool:
+        async with httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT) as client:
+            # Start every tile download at once; HTTP/2 multiplexes them as streams over the
+            # pooled connections, and only the decode / url lookup stage is capped
+            downloads = {t: asyncio.ensure_future(fetch_tile_bytes(client, t.x, t.y, t.z)) for t in tiles}
+
+            async def run_tile(tile):
+                await asyncio.wait([downloads[tile]])
+                async with tile_slots:
+                    return await process_tile(client, process_pool, tile, downloads[tile], needs_check=tile not in interior)
+
+            tasks = [run_tile(t) for t in tiles]
+            for next_done in tqdm(asyncio.as_completed(tasks),
+                                  total=len(tasks),
+                                  desc="Processing tiles",
+                                  unit="tile"):
+                records.extend(await next_done)
 
     # Write CSV: id, captured_at_ms, lon, lat, url
     with open(OUTFILE, "w", newline="") as f:
@@ -97,5 +217,13 @@ def main():
 
     print(f"Done — saved {len(records)} records to {OUTFILE}")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Extract Mapillary image urls")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"ignore cached image urls in {URL_CACHE_DIR} and re-query (and refresh) them")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    read_url_cache = not args.no_cache
+    asyncio.run(main())
\ No newline at end of file
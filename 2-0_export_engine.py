@@ -0,0 +1,56 @@
+import os
+import argparse
+import httpx
+import pandas as pd
+from tqdm import tqdm
+from ultralytics import YOLO
+
+# One-off: compile the tent classifier into a TensorRT engine (FP16, or INT8 with --int8) for
+# the 2_detect_tents*.py scripts.
+# The engine is specific to the GPU and TensorRT version it is built with, so build it
+# on the machine that runs the detection.
+WEIGHTS_PATH = 'yolo/weights/best.pt'
+MAX_BATCH = 32  # dynamic batch up to the largest BATCH_SIZE among the detect scripts
+
+CALIB_DIR = 'yolo/calib'  # unlabelled frames for INT8 calibration, in classify dataset layout
+CALIB_SIZE = 500
+
+# Download a random sample of the frames to classify; calibration only needs the inputs to
+# be representative, so they all go in one placeholder class of the val split it reads
+def build_calibration_set(csv_path):
+    urls = pd.read_csv(csv_path, usecols=['url'])['url'].dropna()
+    urls = urls.sample(min(CALIB_SIZE, len(urls)), random_state=0)
+    frames_dir = os.path.join(CALIB_DIR, 'val', 'frames')
+    os.makedirs(frames_dir, exist_ok=True)
+    os.makedirs(os.path.join(CALIB_DIR, 'train', 'frames'), exist_ok=True)
+
+    with httpx.Client(timeout=10) as client:
+        for i, url in enumerate(tqdm(urls, desc="Calibration frames")):
+            try:
+                r = client.get(url)
+                r.raise_for_status()
+            except httpx.HTTPError:
+                continue
+            with open(os.path.join(frames_dir, f"{i}.jpg"), "wb") as f:
+                f.write(r.content)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the tent classifier to a TensorRT engine")
+    parser.add_argument("--int8", metavar="CSV",
+                        help=f"build an INT8 engine calibrated on {CALIB_SIZE} frames sampled from this url CSV")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    model = YOLO(WEIGHTS_PATH)
+    imgsz = int(model.overrides.get('imgsz', 224))  # keep the resolution the classifier was trained at
+
+    if args.int8:
+        build_calibration_set(args.int8)
+        precision = dict(int8=True, data=CALIB_DIR)
+    else:
+        precision = dict(half=True)
+
+    engine_path = model.export(format='engine', imgsz=imgsz, batch=MAX_BATCH, dynamic=True,
+                               device=0, workspace=4, **precision)
+    print(f"Exported TensorRT engine to {engine_path}")
@@ -1,98 +1,224 @@
 import pandas as pd
-import requests
-from PIL import Image
-from io import BytesIO
+import numpy as np
+import csv
+import asyncio
+import httpx
 from ultralytics import YOLO
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from ultralytics.nn.autobackend import AutoBackend
 from tqdm import tqdm
 import torch
+import torchvision.transforms.functional as F
+from torchvision.io import decode_jpeg, ImageReadMode
+import warnings
+import itertools
 import os
 import sys
 
 # Configuration
 chunk_id = int(sys.argv[1])
-MODEL_PATH = 'yolo/weights/best.pt'
+WEIGHTS_PATH = 'yolo/weights/best.pt'
+ENGINE_PATH = 'yolo/weights/best.engine'  # built by 2-0_export_engine.py
 INPUT_CSV = f'chunk_{chunk_id}.csv'
 OUTPUT_CSV = f'output_chunk_{chunk_id}.csv'
 INTERMEDIATE_CSV = f'intermediate_chunk_{chunk_id}.csv'
 URL_COL = 'url'
 
-NUM_WORKERS = 10
+NUM_WORKERS = 64          # concurrent downloads, multiplexed over HTTP/2
+MAX_CONNECTIONS = 64
 BATCH_SIZE = 16
+QUEUE_SIZE = 4 * BATCH_SIZE  # downloaded images waiting for the GPU
 SAVE_EVERY = 3000
 
-# Load YOLO classifier on GPU
+# Load YOLO classifier on GPU: TensorRT engine if one was exported, else the PyTorch weights
+# (FP16 on CUDA, FP32 fallback on CPU)
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
-model = YOLO(MODEL_PATH).to(device)
+use_half = device == 'cuda'
+MODEL_PATH = ENGINE_PATH if use_half and os.path.exists(ENGINE_PATH) else WEIGHTS_PATH
+net = AutoBackend(MODEL_PATH, device=torch.device(device), fp16=use_half)
+IMGSZ = int(YOLO(WEIGHTS_PATH).overrides.get('imgsz', 224))  # resolution the classifier was trained at
+print(f"Loaded {MODEL_PATH} on {device}")
 
-# Load and prepare CSV
+# Network input buffers, allocated once and refilled in place: one being classified, one
+# queued, one being decoded into (BATCH_SIZE must not exceed the engine's MAX_BATCH). Their
+# dtype follows the network input: FP16 for the half model/engine, FP32 for an INT8 engine
+NUM_INPUT_BUFS = 3
+input_bufs = [torch.empty((BATCH_SIZE, 3, IMGSZ, IMGSZ),
+                          dtype=torch.float16 if net.fp16 else torch.float32, device=device)
+              for _ in range(NUM_INPUT_BUFS)]
+torch.backends.cudnn.benchmark = True  # input shape never changes
+
+# decode_jpeg only reads the response bytes; silence torch's read-only buffer warning
+warnings.filterwarnings("ignore", message="The given buffer is not writable")
+
+# Load CSV; results are collected by row position and assigned to df once at the end
 df = pd.read_csv(INPUT_CSV)
-df['prediction'] = ''
-df['confidence'] = ''
+preds = np.full(len(df), '', dtype=object)
+confs = np.full(len(df), np.nan, dtype=np.float32)
+pending = []  # (row, prediction, confidence) completed since the last checkpoint
+
+# Resume: replay the intermediate CSV (an append-only journal) of an earlier run once
+if os.path.exists(INTERMEDIATE_CSV):
+    print(f"Resuming from {INTERMEDIATE_CSV}")
+    done = pd.read_csv(INTERMEDIATE_CSV, dtype=str, keep_default_na=False)
+    if 'row' not in done.columns and 'prediction' in done.columns:
+        # Full-frame checkpoint from before the journal: rows are the input's, in order
+        done = done.loc[done['prediction'] != '', ['prediction', 'confidence']]
+        done.insert(0, 'row', done.index)
+        tmp = INTERMEDIATE_CSV + ".tmp"
+        done.to_csv(tmp, index=False)  # rewritten as a journal so new rows can be appended
+        os.replace(tmp, INTERMEDIATE_CSV)
+        print(f"Converted full-frame checkpoint to journal ({len(done):,} rows)")
+    done = done.drop_duplicates('row', keep='last')
+    rows = done['row'].to_numpy(dtype=np.int64)
+    preds[rows] = done['prediction'].to_numpy()
+    confs[rows] = pd.to_numeric(done['confidence'], errors='coerce')
+else:
+    with open(INTERMEDIATE_CSV, "w", newline="") as f:
+        csv.writer(f).writerow(['row', 'prediction', 'confidence'])
 
-# Image fetcher
-def fetch_image(idx_url):
-    idx, url = idx_url
+# Rows still to classify (never seen, or failed last time)
+todo = np.flatnonzero((preds == '') | (preds == 'ERROR'))
+
+# Image fetcher (returns the raw JPEG bytes; decoding happens on the GPU)
+async def fetch_image(client, idx, url):
     try:
-        r = requests.get(url, timeout=10)
+        r = await client.get(url)
         r.raise_for_status()
-        img = Image.open(BytesIO(r.content)).convert("RGB")
-        return (idx, img)
+        return (idx, r.content)
     except Exception:
         return (idx, None)
 
-# Classifier batch prediction
-def predict_batch(batch_data):
-    indices, images = zip(*batch_data)
-    results = model(list(images), verbose=False)
+# JPEG decode with nvJPEG on CUDA (libjpeg on CPU); None for frames that fail to decode
+# (including empty bodies, which torch.frombuffer rejects)
+def decode_one(content):
+    try:
+        return decode_jpeg(torch.frombuffer(content, dtype=torch.uint8), mode=ImageReadMode.RGB, device=device)
+    except Exception:
+        return None
+
+def decode_batch(contents):
+    try:
+        raws = [torch.frombuffer(c, dtype=torch.uint8) for c in contents]
+        return decode_jpeg(raws, mode=ImageReadMode.RGB, device=device)
+    except Exception:
+        # One bad frame fails the whole batch; fall back to decoding one by one
+        return [decode_one(c) for c in contents]
+
+# Same as Ultralytics' classify transforms: shortest-side resize, center crop, scale to [0, 1]
+def preprocess(img):
+    img = F.resize(img.float(), IMGSZ, antialias=True)
+    return F.center_crop(img, [IMGSZ, IMGSZ]) / 255
+
+# Decode a batch of downloads into an input buffer; returns the rows kept and the rows that failed
+def decode_into(batch_data, buf):
+    indices, contents = zip(*batch_data)
+    kept, failed = [], []
+    for idx, img in zip(indices, decode_batch(contents)):
+        if img is None:
+            failed.append(idx)
+        else:
+            buf[len(kept)].copy_(preprocess(img))
+            kept.append(idx)
+    return kept, failed
+
+# Classify a filled input buffer straight on the network, bypassing PIL and the Ultralytics predictor
+def predict_batch(buf, kept):
+    # Always run the full buffer (a short final batch leaves stale rows that are ignored)
+    with torch.inference_mode():
+        probs = net(buf)
+    # Classify head returns softmax probabilities (the PyTorch model as [probs, logits])
+    if isinstance(probs, (list, tuple)):
+        probs = probs[0]
+    top1conf, top1 = probs[:len(kept)].float().max(dim=1)
+
     output = []
-    for i, r in enumerate(results):
-        pred_class = int(r.probs.top1)
-        pred_conf = float(r.probs.top1conf)
+    for idx, pred_class, pred_conf in zip(kept, top1.tolist(), top1conf.tolist()):
         label = 'yes' if pred_class == 1 else 'no'
-        output.append((indices[i], label, f"{pred_conf:.3f}"))
+        output.append((idx, label, pred_conf))
     return output
 
-# Save intermediate CSV
+# Store one result in the arrays and queue it for the next checkpoint
+def record(pos, label, conf=np.nan):
+    preds[pos] = label
+    confs[pos] = conf
+    pending.append((pos, label, conf))
+
+# Append the rows completed since the last save to the intermediate CSV
 def save_intermediate():
-    df.to_csv(INTERMEDIATE_CSV, index=False)
-    print(f"Intermediate results saved to {INTERMEDIATE_CSV}")
+    with open(INTERMEDIATE_CSV, "a", newline="") as f:
+        csv.writer(f).writerows(pending)
+    print(f"Intermediate results saved to {INTERMEDIATE_CSV} (+{len(pending)} rows)")
+    pending.clear()
 
-# Main Loop
-batch = []
-processed_since_save = 0
+# Producer: NUM_WORKERS coroutines share one HTTP/2 client and one row iterator
+async def producer(queue):
+    rows = zip(todo, df[URL_COL].to_numpy()[todo])
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=httpx.Timeout(10, pool=None)) as client:
+        async def worker():
+            for idx, url in rows:
+                await queue.put(await fetch_image(client, idx, url))
+        await asyncio.gather(*(worker() for _ in range(NUM_WORKERS)))
+    await queue.put(None)
 
-with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-    futures = [executor.submit(fetch_image, (idx, url)) for idx, url in df[URL_COL].items()]
+# Decoder: group downloads into batches and decode each into the next input buffer, so
+# decoding batch N+1 overlaps with classifying batch N
+async def decoder(download_queue, batch_queue, pbar):
+    batch = []
+    bufs = itertools.cycle(input_bufs)
 
-    for future in tqdm(as_completed(futures), total=len(futures), desc="Fetching + Classifying"):
-        idx, img = future.result()
-        if img is None:
-            df.at[idx, 'prediction'] = 'ERROR'
-            continue
+    while True:
+        item = await download_queue.get()
+        if item is not None:
+            pbar.update(1)
+            pos, content = item
+            if content is None:
+                record(pos, 'ERROR')
+            else:
+                batch.append(item)
 
-        batch.append((idx, img))
+        if batch and (len(batch) >= BATCH_SIZE or item is None):
+            buf = next(bufs)
+            kept, failed = await asyncio.to_thread(decode_into, batch, buf)
+            for pos in failed:
+                record(pos, 'ERROR')
+            await batch_queue.put((buf, kept))
+            batch = []
 
-        if len(batch) >= BATCH_SIZE:
-            preds = predict_batch(batch)
-            for idx_p, label, conf in preds:
-                df.at[idx_p, 'prediction'] = label
-                df.at[idx_p, 'confidence'] = conf
+        if item is None:
+            break
+    await batch_queue.put(None)
+
+# Consumer: classify decoded batches; inference runs in a thread so downloads continue meanwhile
+async def consumer(batch_queue):
+    processed_since_save = 0
+
+    while (item := await batch_queue.get()) is not None:
+        buf, kept = item
+        if kept:
+            for pos_p, label, conf in await asyncio.to_thread(predict_batch, buf, kept):
+                record(pos_p, label, conf)
                 processed_since_save += 1
-            batch.clear()
 
         if processed_since_save >= SAVE_EVERY:
             save_intermediate()
             processed_since_save = 0
 
-    # Final batch
-    if batch:
-        preds = predict_batch(batch)
-        for idx_p, label, conf in preds:
-            df.at[idx_p, 'prediction'] = label
-            df.at[idx_p, 'confidence'] = conf
     save_intermediate()
 
+# Main Loop
+async def main():
+    download_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    batch_queue = asyncio.Queue(maxsize=NUM_INPUT_BUFS - 2)  # bounds the buffers in flight
+    with tqdm(total=len(todo), desc="Fetching + Classifying") as pbar:
+        await asyncio.gather(producer(download_queue),
+                             decoder(download_queue, batch_queue, pbar),
+                             consumer(batch_queue))
+
+asyncio.run(main())
+
 # Save final result
+df['prediction'] = preds
+df['confidence'] = confs.round(3)  # written as e.g. 0.912
 df.to_csv(OUTPUT_CSV, index=False)
-print(f"All predictions saved to {OUTPUT_CSV}")
\ No newline at end of file
+print(f"All predictions saved to {OUTPUT_CSV}")
@@ -3,7 +3,8 @@ import requests
 from PIL import Image
 from io import BytesIO
 from ultralytics import YOLO
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import itertools
 from tqdm import tqdm
 import torch
 import os
@@ -18,6 +19,7 @@ URL_COL = 'url'
 NUM_WORKERS = 20
 BATCH_SIZE = 32
 SAVE_EVERY = 3000
+MAX_IN_FLIGHT = 2 * NUM_WORKERS * BATCH_SIZE  # queued downloads (not one future per row)
 
 # Load YOLO classifier on GPU
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -56,15 +58,26 @@ def save_intermediate():
     df.to_csv(INTERMEDIATE_CSV, index=False)
     print(f"💾 Intermediate results saved to {INTERMEDIATE_CSV}")
 
+# Fetch results as they complete, keeping at most MAX_IN_FLIGHT downloads submitted at a time
+def fetch_all(executor, rows):
+    rows = iter(rows)
+    inflight = set()
+    while True:
+        for idx_url in itertools.islice(rows, MAX_IN_FLIGHT - len(inflight)):
+            inflight.add(executor.submit(fetch_image, idx_url))
+        if not inflight:
+            return
+        done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
 # Main Loop
 batch = []
 processed_since_save = 0
 
 with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-    futures = [executor.submit(fetch_image, (idx, url)) for idx, url in df[URL_COL].items()]
-
-    for future in tqdm(as_completed(futures), total=len(futures), desc="Fetching + Classifying"):
-        idx, img = future.result()
+    rows = zip(df.index, df[URL_COL].to_numpy())
+    for idx, img in tqdm(fetch_all(executor, rows), total=len(df), desc="Fetching + Classifying"):
         if img is None:
             df.at[idx, 'prediction'] = 'ERROR'
             continue
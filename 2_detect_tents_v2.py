@@ -1,11 +1,14 @@
 import pandas as pd
+import numpy as np
 import requests
 from PIL import Image
 from io import BytesIO
 from ultralytics import YOLO
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
 import torch
+import torchvision.transforms.functional as F
+import itertools
 import os
 import sys
 
@@ -13,7 +16,8 @@ import sys
 chunk_id = int(sys.argv[1])
 
 # Configuration
-MODEL_PATH = 'yolo/weights/best.pt'
+WEIGHTS_PATH = 'yolo/weights/best.pt'
+ENGINE_PATH = 'yolo/weights/best.engine'  # built by 2-0_export_engine.py
 INPUT_CSV = f'chunk_{chunk_id}.csv'
 INTERMEDIATE_CSV = f'intermediate_chunk_{chunk_id}.csv'
 OUTPUT_CSV = f'output_chunk_{chunk_id}.csv'
@@ -22,10 +26,27 @@ URL_COL = 'url'
 NUM_WORKERS = 10
 BATCH_SIZE = 32
 SAVE_EVERY = 10000
+MAX_IN_FLIGHT = 2 * NUM_WORKERS * BATCH_SIZE  # queued downloads (not one future per row)
 
-# Load model
+# Load model: TensorRT engine if one was exported (GPU only), else the PyTorch weights
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
-model = YOLO(MODEL_PATH).to(device)
+MODEL_PATH = ENGINE_PATH if device == 'cuda' and os.path.exists(ENGINE_PATH) else WEIGHTS_PATH
+model = YOLO(MODEL_PATH, task='classify')
+if MODEL_PATH == WEIGHTS_PATH:
+    model.to(device)  # exported engines are already bound to the GPU
+print(f"Loaded {MODEL_PATH} on {device}")
+IMGSZ = int(YOLO(WEIGHTS_PATH).overrides.get('imgsz', 224))  # resolution the classifier was trained at
+
+# Input buffers allocated once and refilled in place: two pairs of a pinned host staging buffer
+# and the device tensor the network reads, so batch N+1 is copied to the GPU on a side stream
+# while batch N is being classified
+NUM_BUFS = 2
+host_bufs = [torch.empty((BATCH_SIZE, 3, IMGSZ, IMGSZ), dtype=torch.uint8, pin_memory=device == 'cuda')
+             for _ in range(NUM_BUFS)]
+input_bufs = [torch.empty((BATCH_SIZE, 3, IMGSZ, IMGSZ), dtype=torch.float32, device=device)
+              for _ in range(NUM_BUFS)]
+slots = itertools.cycle(range(NUM_BUFS))
+copy_stream = torch.cuda.Stream() if device == 'cuda' else None
 
 # Load data
 if os.path.exists(INTERMEDIATE_CSV):
@@ -39,56 +60,113 @@ else:
 # Identify rows that need to be processed
 df_to_process = df[(df['prediction'] == '') | (df['prediction'].isna()) | (df['prediction'] == 'ERROR')].copy()
 
-# Image fetcher
+# Results are kept in arrays by row position (df has a RangeIndex from read_csv, so the
+# index labels above are positions) and assigned to df in bulk before each save; confidences
+# as float32 with NaN for none, rounded once when written
+preds = df['prediction'].to_numpy(dtype=object)
+confs = pd.to_numeric(df['confidence'], errors='coerce').to_numpy(dtype=np.float32)
+
+def record(pos, label, conf=np.nan):
+    preds[pos] = label
+    confs[pos] = conf
+
+# Same as Ultralytics' classify transforms: shortest-side resize, center crop (uint8 CHW)
+def to_tensor(img):
+    img = F.center_crop(F.resize(img, IMGSZ), [IMGSZ, IMGSZ])
+    return F.pil_to_tensor(img)
+
+# Image fetcher; resizes on the worker thread so only model-sized images wait for the GPU
 def fetch_image(idx_url):
     idx, url = idx_url
     try:
         r = requests.get(url, timeout=10)
         r.raise_for_status()
         img = Image.open(BytesIO(r.content)).convert("RGB")
-        return (idx, img)
+        return (idx, to_tensor(img))
     except Exception:
         return (idx, None)
 
-# Prediction batcher
-def predict_batch(batch_data):
+# Stage a uint8 batch in pinned memory and start its copy to the device on the copy stream,
+# scaling it to [0, 1] there (which Ultralytics passes straight to the network)
+def stage_batch(batch_data):
     indices, images = zip(*batch_data)
-    results = model(list(images), verbose=False)
+    slot, n = next(slots), len(images)
+    host, batch = host_bufs[slot][:n], input_bufs[slot][:n]
+    torch.stack(images, out=host)
+    if copy_stream is None:
+        batch.copy_(host).div_(255)
+        return indices, batch, None
+    with torch.cuda.stream(copy_stream):
+        batch.copy_(host, non_blocking=True).div_(255)
+        copied = torch.cuda.Event()
+        copied.record()
+    return indices, batch, copied
+
+# Prediction batcher
+def predict_batch(staged):
+    indices, batch, copied = staged
+    if copied is not None:
+        torch.cuda.current_stream().wait_event(copied)  # only this batch's copy, not the next one's
+    with torch.inference_mode():
+        results = model(batch, verbose=False)
     output = []
     for i, r in enumerate(results):
         pred_class = int(r.probs.top1)
         pred_conf = float(r.probs.top1conf)
         label = 'yes' if pred_class == 1 else 'no'
-        output.append((indices[i], label, f"{pred_conf:.3f}"))
+        output.append((indices[i], label, pred_conf))
     return output
 
 # Save intermediate results
 def save_intermediate():
+    df['prediction'] = preds
+    df['confidence'] = confs.round(3)  # written as e.g. 0.912, as before
     df.to_csv(INTERMEDIATE_CSV, index=False)
     print(f"Saved intermediate to {INTERMEDIATE_CSV}")
 
+# Fetch results as they complete, keeping at most MAX_IN_FLIGHT downloads submitted at a time
+def fetch_all(executor, rows):
+    rows = iter(rows)
+    inflight = set()
+    while True:
+        for idx_url in itertools.islice(rows, MAX_IN_FLIGHT - len(inflight)):
+            inflight.add(executor.submit(fetch_image, idx_url))
+        if not inflight:
+            return
+        done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
 # Main loop
 batch = []
+staged = None  # previous batch, on its way to the GPU
 processed_since_save = 0
 
-with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-    futures = [executor.submit(fetch_image, (idx, url)) for idx, url in df_to_process[URL_COL].items()]
+# Stage the collected batch, then classify the one staged before it, so each copy overlaps
+# the previous batch's inference (an empty batch just drains the last staged one)
+def advance(batch_data):
+    global staged, processed_since_save
+    next_staged = stage_batch(batch_data) if batch_data else None
+    try:
+        if staged is not None:
+            for idx_p, label, conf in predict_batch(staged):
+                record(idx_p, label, conf)
+                processed_since_save += 1
+    finally:
+        staged = next_staged
 
-    for future in tqdm(as_completed(futures), total=len(futures), desc=f"Chunk {chunk_id}"):
-        idx, img = future.result()
+with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+    rows = zip(df_to_process.index, df_to_process[URL_COL].to_numpy())
+    for idx, img in tqdm(fetch_all(executor, rows), total=len(df_to_process), desc=f"Chunk {chunk_id}"):
         if img is None:
-            df.at[idx, 'prediction'] = 'ERROR'
+            record(idx, 'ERROR')
             continue
 
         batch.append((idx, img))
 
         if len(batch) >= BATCH_SIZE:
             try:
-                preds = predict_batch(batch)
-                for idx_p, label, conf in preds:
-                    df.at[idx_p, 'prediction'] = label
-                    df.at[idx_p, 'confidence'] = conf
-                    processed_since_save += 1
+                advance(batch)
                 batch.clear()
             except Exception as e:
                 print(f"Batch prediction failed: {e}")
@@ -98,13 +176,10 @@ with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
             save_intermediate()
             processed_since_save = 0
 
-# Final batch
-if batch:
+# Final batches: the partial one still collecting, then the last staged one
+for final_batch in (batch, []):
     try:
-        preds = predict_batch(batch)
-        for idx_p, label, conf in preds:
-            df.at[idx_p, 'prediction'] = label
-            df.at[idx_p, 'confidence'] = conf
+        advance(final_batch)
     except Exception as e:
         print(f"Final batch failed: {e}")
 
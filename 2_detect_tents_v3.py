@@ -1,41 +1,59 @@
 import os
+import sqlite3
 import sys
 import time
 import signal
 import threading
+import queue
+import asyncio
 import pandas as pd
-import requests
-from PIL import Image
-from io import BytesIO
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import httpx
 from ultralytics import YOLO
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from ultralytics.nn.autobackend import AutoBackend
 from tqdm import tqdm
 import torch
+import torchvision.transforms.functional as F
+from torchvision.io import decode_jpeg, decode_image, ImageReadMode
+import warnings
 import glob
+import contextlib
 import re
-
-# Parse chunk ID from CLI
-chunk_id = int(sys.argv[1])  # e.g., python run_chunk_safe.py 3
-
-# Config
-MODEL_PATH = 'yolo/weights/best.pt'
-INPUT_CSV = f'data_chunks/chunk_{chunk_id}.csv'
-INTERMEDIATE_CSV = f'output/intermediate_chunk_{chunk_id}.csv'
-OUTPUT_CSV = f'output/output_chunk_{chunk_id}.csv'
+import hashlib
+import tempfile
+
+# Config (paths are per chunk; chunk ids come from the CLI, see the bottom of the file).
+# The path templates can be overridden from the environment, e.g. INPUT_CSV='chunk_{chunk_id}.csv'
+# OUTPUT_CSV='output_chunk_{chunk_id}.csv' for chunks kept in the working directory
+WEIGHTS_PATH = 'yolo/weights/best.pt'
+ENGINE_PATH = 'yolo/weights/best.engine'  # built by 2-0_export_engine.py
+INPUT_CSV = os.getenv('INPUT_CSV', 'data_chunks/chunk_{chunk_id}.csv')
+RESULTS_DB = os.getenv('RESULTS_DB', 'output/results_chunk_{chunk_id}.db')  # one row per classified image, for resume
+OUTPUT_CSV = os.getenv('OUTPUT_CSV', 'output/output_chunk_{chunk_id}.csv')
+# CSV checkpoints of earlier runs (or of v2 / 2_detect_tents.py), imported into RESULTS_DB;
+# by default next to it, so overriding RESULTS_DB for another layout finds them too
+RESULTS_DIR = os.path.dirname(RESULTS_DB)
+LEGACY_INTERMEDIATE_CSV = os.getenv('LEGACY_INTERMEDIATE_CSV',
+                                    os.path.join(RESULTS_DIR, 'intermediate_chunk_{chunk_id}.csv'))
+LEGACY_JOURNAL_CSV = os.getenv('LEGACY_JOURNAL_CSV', os.path.join(RESULTS_DIR, 'journal_chunk_{chunk_id}.csv'))
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', '')  # downloaded bytes, e.g. output/image_cache; off by default
 URL_COL = 'url'
+PRED_DTYPE = pd.CategoricalDtype(categories=['no', 'yes', 'ERROR'])
+ERROR = PRED_DTYPE.categories.get_loc('ERROR')  # category code; -1 = not processed yet
 
-NUM_WORKERS = int(os.getenv('NUM_WORKERS', 10))
-BATCH_SIZE = int(os.getenv('BATCH_SIZE', 32))
-SAVE_EVERY = int(os.getenv('SAVE_EVERY', 10000))  # processed rows since last save
+NUM_WORKERS = int(os.getenv('NUM_WORKERS', 50))        # concurrent downloads, multiplexed over HTTP/2
+DECODE_WORKERS = int(os.getenv('DECODE_WORKERS', 4))   # JPEG decode (nvJPEG on CUDA) + resize threads, split across GPUs
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 32))  # at most the engine's MAX_BATCH
+QUEUE_SIZE = 4 * BATCH_SIZE  # items buffered between pipeline stages
 
 REQUEST_TIMEOUT = 12
 MAX_RETRIES = 3
 BACKOFF_BASE = 1.5  # exponential backoff factor
 
-os.makedirs(os.path.dirname(INTERMEDIATE_CSV), exist_ok=True)
 
-
-# keep the last N timestamped backups alongside the "live" intermediate file
+# keep the last N timestamped backups alongside the "live" output file
 KEEP_BACKUPS = int(os.getenv("KEEP_BACKUPS", 2))
 
 _TS_RE = re.compile(r"\.\d{8}_\d{6}$")  # matches ".YYYYMMDD_HHMMSS" at end
@@ -58,10 +76,18 @@ def cleanup_backups(base_path: str, keep: int = KEEP_BACKUPS):
         except Exception as e:
             print(f"Could not delete backup {p}: {e}")
 
+# CSV I/O through pyarrow's multithreaded parser/writer; result columns are read as text
+# (empty = not processed yet) and converted to their in-memory dtypes after loading
+RESULT_TYPES = {'prediction': pa.string(), 'confidence': pa.string()}
+
+def read_csv(path: str) -> pd.DataFrame:
+    opts = pacsv.ConvertOptions(column_types=RESULT_TYPES)
+    return pacsv.read_csv(path, convert_options=opts).to_pandas()
+
 # Atomic save helpers
 def atomic_save_csv(df: pd.DataFrame, path: str):
     tmp = path + ".tmp"
-    df.to_csv(tmp, index=False)
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), tmp)
     os.replace(tmp, path)  # atomic on POSIX
 
 def rotate_and_save(df: pd.DataFrame, path: str):
@@ -76,144 +102,355 @@ def rotate_and_save(df: pd.DataFrame, path: str):
 shutdown_flag = threading.Event()
 
 def _handle_signal(signum, frame):
-    print(f"\n Received signal {signum}. Saving intermediate and exiting…")
+    print(f"\n Received signal {signum}. Saving results and exiting…")
     shutdown_flag.set()
 signal.signal(signal.SIGTERM, _handle_signal)
 signal.signal(signal.SIGINT, _handle_signal)
 
-# Load model
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-model = YOLO(MODEL_PATH).to(device)
-
-# Load/Resume data
-if os.path.exists(INTERMEDIATE_CSV):
-    print(f"Resuming from {INTERMEDIATE_CSV}")
-    df = pd.read_csv(INTERMEDIATE_CSV)
-else:
-    df = pd.read_csv(INPUT_CSV)
-    if 'prediction' not in df.columns: df['prediction'] = ''
-    if 'confidence' not in df.columns: df['confidence'] = ''
+# Load model once for every chunk, with one copy per visible GPU: TensorRT engine if one was
+# exported (GPU only), else the PyTorch weights (FP16 on CUDA, FP32 fallback on CPU)
+devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())] or ['cpu']
+use_half = devices[0] != 'cpu'
+MODEL_PATH = ENGINE_PATH if use_half and os.path.exists(ENGINE_PATH) else WEIGHTS_PATH
+IMGSZ = int(YOLO(WEIGHTS_PATH).overrides.get('imgsz', 224))  # resolution the classifier was trained at
+
+def load_net(device):
+    with torch.cuda.device(device) if device != 'cpu' else contextlib.nullcontext():
+        return AutoBackend(MODEL_PATH, device=torch.device(device), fp16=use_half)
+
+nets = [load_net(d) for d in devices]
+print(f"Loaded {MODEL_PATH} on {', '.join(devices)}")
+
+# Network input buffer per GPU, allocated once and refilled in place every batch; its dtype follows
+# the network input (FP16 for the half model/engine, FP32 for an INT8 engine or on CPU)
+input_bufs = [torch.empty((BATCH_SIZE, 3, IMGSZ, IMGSZ),
+                          dtype=torch.float16 if net.fp16 else torch.float32, device=d)
+              for d, net in zip(devices, nets)]
+
+# Optional image byte cache, content-addressed by SHA-1 of the url: a restarted or resumed run
+# reads frames it already downloaded from disk instead of fetching them again. It is never
+# pruned (full-size frames, so size the disk for the chunk), and only holds JPEGs: any other
+# body is refetched next time rather than failing as ERROR on every rerun
+JPEG_SOI = b"\xff\xd8"
+cache_failed = threading.Event()  # set on the first write error (e.g. disk full); stops caching
+
+def cache_path(url):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, key[:2], key)
+
+def read_cached(path):
+    # Any read error (missing file, EACCES, EIO, ...) is a cache miss: the frame is downloaded
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+    except OSError:
+        return None
+    return content if content.startswith(JPEG_SOI) else None
+
+def write_cached(path, content):
+    # Best effort (a full disk must not fail the download); written atomically via a temp file
+    if cache_failed.is_set() or not content.startswith(JPEG_SOI):
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            f.write(content)
+        os.replace(f.name, path)
+    except OSError as e:
+        cache_failed.set()
+        print(f"Could not cache {path}: {e}. Image cache disabled for this run")
+
+# Image fetcher with retries/backoff (returns the raw JPEG bytes)
+async def fetch_image(client, idx, url):
+    path = cache_path(url) if IMAGE_CACHE_DIR else None
+    if path and (content := await asyncio.to_thread(read_cached, path)) is not None:
+        return (idx, content)
 
-total_rows = len(df)
-already_done = ((df['prediction'] != '') & (df['prediction'] != 'ERROR') & (~df['prediction'].isna())).sum()
-df_to_process = df[(df['prediction'].isna()) | (df['prediction'] == '') | (df['prediction'] == 'ERROR')].copy()
-todo_rows = len(df_to_process)
-
-print(f"Chunk {chunk_id}: total={total_rows:,} | done={already_done:,} | to_process={todo_rows:,}")
-assert URL_COL in df.columns, f"Missing column '{URL_COL}' in {INPUT_CSV}"
-
-# Requests Session (connection pooling)
-_session_local = threading.local()
-def get_session():
-    if not hasattr(_session_local, "session"):
-        s = requests.Session()
-        s.headers.update({"User-Agent": "yolo-batch-classifier/1.0"})
-        _session_local.session = s
-    return _session_local.session
-
-# Image fetcher with retries/backoff
-def fetch_image(idx_url):
-    idx, url = idx_url
-    sess = get_session()
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            r = sess.get(url, timeout=REQUEST_TIMEOUT)
+            r = await client.get(url)
             r.raise_for_status()
-            img = Image.open(BytesIO(r.content)).convert("RGB")
-            return (idx, img)
+            break
         except Exception:
             if attempt == MAX_RETRIES:
                 return (idx, None)
-            time.sleep(BACKOFF_BASE ** attempt)
+            await asyncio.sleep(BACKOFF_BASE ** attempt)
+    if path:
+        await asyncio.to_thread(write_cached, path, r.content)
+    return (idx, r.content)
+
+# Same as Ultralytics' classify transforms: shortest-side resize, center crop (uint8 CHW)
+def resize_crop(img):
+    img = F.resize(img, IMGSZ, antialias=True)
+    return F.center_crop(img, [IMGSZ, IMGSZ])
+
+# decode_jpeg only reads the response bytes; silence torch's read-only buffer warning
+warnings.filterwarnings("ignore", message="The given buffer is not writable")
+
+# Decode + resize into the given device's memory: nvJPEG on CUDA, with torchvision's CPU decoder
+# (libjpeg-turbo, also PNG) for frames nvJPEG rejects; None for frames that fail to decode,
+# including empty bodies (torch.frombuffer raises ValueError on those)
+def load_image(content, device):
+    try:
+        raw = torch.frombuffer(content, dtype=torch.uint8)
+    except Exception:
+        return None
+    if device != 'cpu':
+        try:
+            return resize_crop(decode_jpeg(raw, mode=ImageReadMode.RGB, device=device))
+        except Exception:
+            pass
+    try:
+        return resize_crop(decode_image(raw, mode=ImageReadMode.RGB)).to(device)
+    except Exception:
+        return None
+
+# Pipeline: fetch thread (asyncio HTTP/2 client) -> decode threads (JPEG decode + resize), each
+# feeding one GPU -> one classifier thread per GPU -> main thread (records results), joined by
+# bounded queues so network, decode and every GPU all overlap
+NUM_DECODERS = max(DECODE_WORKERS, len(devices))  # at least one per GPU
+decoder_devices = [i % len(devices) for i in range(NUM_DECODERS)]  # GPU each decoder feeds
+
+fetch_q = queue.Queue(maxsize=QUEUE_SIZE)   # (idx, bytes or None)
+decode_qs = [queue.Queue(maxsize=QUEUE_SIZE) for _ in devices]  # per GPU: (idx, uint8 tensor or None)
+result_q = queue.Queue()  # lists of (idx, label, conf); None once per GPU
+
+# NUM_WORKERS coroutines share one HTTP/2 client (one TLS handshake) and one row iterator
+async def fetch_all(rows):
+    limits = httpx.Limits(max_connections=NUM_WORKERS, max_keepalive_connections=NUM_WORKERS)
+    async with httpx.AsyncClient(http2=True, limits=limits,
+                                 timeout=httpx.Timeout(REQUEST_TIMEOUT, pool=None),
+                                 headers={"User-Agent": "yolo-batch-classifier/1.0"}) as client:
+        async def worker():
+            for idx, url in rows:
+                if shutdown_flag.is_set():
+                    return
+                # Blocks in a helper thread while fetch_q is full, pausing this downloader
+                await asyncio.to_thread(fetch_q.put, await fetch_image(client, idx, url))
+        await asyncio.gather(*(worker() for _ in range(NUM_WORKERS)))
+
+def fetch_worker(rows):
+    try:
+        asyncio.run(fetch_all(rows))
+    finally:
+        for _ in range(NUM_DECODERS):
+            fetch_q.put(None)  # even if fetching failed, so the decoders still finish
 
-# Batch prediction
-def predict_batch(batch_data):
+def decode_worker(gpu):
+    device, out_q = devices[gpu], decode_qs[gpu]
+    try:
+        while (item := fetch_q.get()) is not None:
+            idx, content = item
+            out_q.put((idx, None if content is None else load_image(content, device)))
+    finally:
+        out_q.put(None)  # even if this thread dies, so its GPU consumer can still finish
+
+# Classifier thread for one GPU: batch its decoded images and classify them; rows that failed
+# to download or decode are passed on as ERROR
+def gpu_worker(gpu):
+    if devices[gpu] != 'cpu':
+        torch.cuda.set_device(devices[gpu])  # per thread: the engine runs on this GPU
+    in_q, n_decoders = decode_qs[gpu], decoder_devices.count(gpu)
+    batch, finished = [], 0
+
+    while finished < n_decoders:
+        item = in_q.get()
+        if item is None:
+            finished += 1
+        elif item[1] is None:
+            result_q.put([(item[0], 'ERROR', np.nan)])
+        else:
+            batch.append(item)
+
+        if batch and (len(batch) >= BATCH_SIZE or finished == n_decoders):
+            try:
+                result_q.put(predict_batch(gpu, batch))
+            except Exception as e:
+                print(f"Batch prediction failed: {e}")
+            batch = []
+    result_q.put(None)
+
+def start_pipeline(rows):
+    threading.Thread(target=fetch_worker, args=(iter(rows),), daemon=True).start()
+    for gpu in decoder_devices:
+        threading.Thread(target=decode_worker, args=(gpu,), daemon=True).start()
+    for gpu in range(len(devices)):
+        threading.Thread(target=gpu_worker, args=(gpu,), daemon=True).start()
+
+# Classified rows in arrival order; ends once every GPU has finished its last batch
+def classified_batches():
+    finished = 0
+    while finished < len(devices):
+        try:
+            item = result_q.get(timeout=1)  # wake up periodically to notice a shutdown signal
+        except queue.Empty:
+            if shutdown_flag.is_set():
+                return
+            continue
+        if item is None:
+            finished += 1
+        else:
+            yield item
+
+# Batch prediction on one GPU
+def predict_batch(gpu, batch_data):
     indices, images = zip(*batch_data)
-    # verbose=False suppresses per-image prints
-    results = model(list(images), verbose=False)
+    # Images were decoded straight into device memory, so there is no host-to-device copy;
+    # the batch is scaled to [0, 1] there and classified straight on the network, bypassing
+    # the Ultralytics predictor and its per-image Results objects
+    batch = input_bufs[gpu][:len(images)]
+    for slot, img in zip(batch, images):
+        slot.copy_(img)
+    batch.div_(255)
+    with torch.inference_mode():
+        probs = nets[gpu](batch)
+    # Classify head returns softmax probabilities (the PyTorch model as [probs, logits])
+    if isinstance(probs, (list, tuple)):
+        probs = probs[0]
+    # Top-1 for the whole batch at once: one device-to-host transfer instead of two per image
+    top1conf, top1 = probs.float().max(dim=1)
+
     out = []
-    for i, r in enumerate(results):
-        pred_class = int(r.probs.top1)
-        pred_conf = float(r.probs.top1conf)
+    for idx, pred_class, pred_conf in zip(indices, top1.tolist(), top1conf.tolist()):
         label = 'yes' if pred_class == 1 else 'no'
-        out.append((indices[i], label, f"{pred_conf:.3f}"))
+        out.append((idx, label, pred_conf))
     return out
 
-# Save helpers
-processed_since_save = 0
-save_lock = threading.Lock()
-
-def save_intermediate(tag=""):
-    with save_lock:
-        rotate_and_save(df, INTERMEDIATE_CSV)
-        filled = ((df['prediction'] != '') & (~df['prediction'].isna())).sum()
-        print(f"Saved intermediate{(' '+tag) if tag else ''}: "
-              f"{INTERMEDIATE_CSV} | rows={len(df):,} | filled={filled:,}")
-
-# Main
-batch = []
-
-try:
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-        futures = [executor.submit(fetch_image, (idx, url))
-                   for idx, url in df_to_process[URL_COL].items()]
-
-        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Chunk {chunk_id}"):
-            if shutdown_flag.is_set():
-                save_intermediate("(shutdown)")
-                break
-
-            idx, img = future.result()
-            if img is None:
-                # Keep row so final length matches input; mark ERROR for resume
-                df.at[idx, 'prediction'] = 'ERROR'
-                continue
-
-            batch.append((idx, img))
-
-            if len(batch) >= BATCH_SIZE:
-                try:
-                    preds = predict_batch(batch)
-                    for idx_p, label, conf in preds:
-                        df.at[idx_p, 'prediction'] = label
-                        df.at[idx_p, 'confidence'] = conf
-                        processed_since_save += 1
-                    batch.clear()
-                except Exception as e:
-                    print(f"Batch prediction failed: {e}")
-                    batch.clear()
-
-                if processed_since_save >= SAVE_EVERY:
-                    save_intermediate()
-                    processed_since_save = 0
-
-    # Final batch (if we didn’t exit early)
-    if not shutdown_flag.is_set() and batch:
-        try:
-            preds = predict_batch(batch)
-            for idx_p, label, conf in preds:
-                df.at[idx_p, 'prediction'] = label
-                df.at[idx_p, 'confidence'] = conf
-        except Exception as e:
-            print(f"Final batch failed: {e}")
-
-    save_intermediate("(final)")
-
-    # Final output save (atomic) + integrity check
-    rotate_and_save(df, OUTPUT_CSV)
-    print(f"Saved final output to {OUTPUT_CSV} | rows={len(df):,}")
-
-    # Optional on-disk verification (catch truncation)
-    _ver = pd.read_csv(OUTPUT_CSV, nrows=5)  # light read just to ensure readable
-    if len(df) != total_rows:
-        print(f"WARNING: in-memory rows {len(df)} != input rows {total_rows}")
-    assert len(df) == total_rows, f"Row count changed in memory: {len(df)} vs {total_rows}"
+# Seed an empty results store from the CSV checkpoint used before it: the full-frame snapshot
+# (rows by position), then the journal of rows completed after it. The intermediate file is
+# itself a journal (row column) when it was written by 2_detect_tents.py
+def import_legacy_checkpoint(conn, chunk_id):
+    snapshot_csv = LEGACY_INTERMEDIATE_CSV.format(chunk_id=chunk_id)
+    journal_csv = LEGACY_JOURNAL_CSV.format(chunk_id=chunk_id)
+    parts = []
+    if os.path.exists(snapshot_csv):
+        snap = read_csv(snapshot_csv)
+        if 'row' in snap.columns:
+            parts.append(snap[['row', 'prediction', 'confidence']])
+        elif 'prediction' in snap.columns:
+            parts.append(pd.DataFrame({'row': np.arange(len(snap)), 'prediction': snap['prediction'],
+                                       'confidence': snap.get('confidence')}))
+    if os.path.exists(journal_csv):
+        parts.append(read_csv(journal_csv)[['row', 'prediction', 'confidence']])
+    if not parts:
+        return
+
+    done = pd.concat(parts, ignore_index=True)
+    done = done[done['prediction'].isin(PRED_DTYPE.categories)].drop_duplicates('row', keep='last')
+    confs = pd.to_numeric(done['confidence'], errors='coerce')
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO p VALUES (?, ?, ?)",
+                         zip(done['row'].astype(int).tolist(), done['prediction'].tolist(), confs.tolist()))
+    print(f"Imported {len(done):,} rows from {snapshot_csv} / {journal_csv}")
+
+# Classify one chunk end to end: load/resume, run the pipeline, record results, save the output
+def process_chunk(chunk_id):
+    input_csv = INPUT_CSV.format(chunk_id=chunk_id)
+    results_db = RESULTS_DB.format(chunk_id=chunk_id)
+    output_csv = OUTPUT_CSV.format(chunk_id=chunk_id)
+    for path in (results_db, output_csv):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    df = read_csv(input_csv)
+    if 'prediction' not in df.columns: df['prediction'] = ''
+    if 'confidence' not in df.columns: df['confidence'] = ''
 
-except Exception as e:
-    # Save something if we crash unexpectedly
-    print(f"Exception: {e}. Saving emergency intermediate…")
+    # Results are kept in arrays by row position: predictions as category codes, confidences
+    # as float32 (NaN = none); both are assigned to df in bulk before the output is written
+    df['prediction'] = df['prediction'].astype(PRED_DTYPE)
+    df['confidence'] = pd.to_numeric(df['confidence'], errors='coerce').astype('float32')
+    pred_codes = df['prediction'].cat.codes.to_numpy().copy()
+    confs = df['confidence'].to_numpy().copy()
+    pending = []  # (row, prediction, confidence) not yet written to the results store
+
+    def sync_results():
+        df['prediction'] = pd.Categorical.from_codes(pred_codes, dtype=PRED_DTYPE)
+        df['confidence'] = confs.round(3)  # written as e.g. 0.912 by the CSV writer
+
+    # Results store: each batch's rows are upserted by position and committed, so a checkpoint
+    # costs one small WAL write instead of rewriting the whole frame
+    conn = sqlite3.connect(results_db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS p (idx INTEGER PRIMARY KEY, pred TEXT, conf REAL)")
+    if conn.execute("SELECT COUNT(*) FROM p").fetchone()[0] == 0:
+        import_legacy_checkpoint(conn, chunk_id)
+
+    # Resume: apply the results of earlier runs
+    done = pd.read_sql("SELECT idx, pred, conf FROM p", conn)
+    if len(done):
+        print(f"Resuming {len(done):,} rows from {results_db}")
+        rows = done['idx'].to_numpy(dtype=np.int64)
+        pred_codes[rows] = pd.Categorical(done['pred'], dtype=PRED_DTYPE).codes
+        confs[rows] = done['conf'].to_numpy(dtype=np.float32)
+
+    assert URL_COL in df.columns, f"Missing column '{URL_COL}' in {input_csv}"
+
+    # Rows still to classify (never seen, or failed last time), as positions and their urls
+    total_rows = len(df)
+    todo = (pred_codes < 0) | (pred_codes == ERROR)
+    todo_idx = np.flatnonzero(todo)
+    todo_urls = df[URL_COL].to_numpy()[todo]
+    todo_rows = len(todo_idx)
+    already_done = total_rows - todo_rows
+
+    print(f"Chunk {chunk_id}: total={total_rows:,} | done={already_done:,} | to_process={todo_rows:,}")
+
+    def record(pos, label, conf=np.nan):
+        pred_codes[pos] = PRED_DTYPE.categories.get_loc(label)
+        confs[pos] = conf
+        pending.append((int(pos), label, conf))
+
+    def save_results():
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO p VALUES (?, ?, ?)", pending)
+        pending.clear()
+
+    # Main
     try:
-        save_intermediate("(exception)")
-    except Exception as ee:
-        print(f"Failed to save intermediate: {ee}")
-    raise
+        start_pipeline(zip(todo_idx, todo_urls))
+
+        with tqdm(total=todo_rows, desc=f"Chunk {chunk_id}") as pbar:
+            for results in classified_batches():
+                if shutdown_flag.is_set():
+                    print(f"Saving results (shutdown): {results_db}")
+                    break
+
+                # ERROR rows keep the final length equal to the input and are retried on resume
+                for idx_p, label, conf in results:
+                    record(idx_p, label, conf)
+                pbar.update(len(results))
+
+                if len(pending) >= BATCH_SIZE:
+                    save_results()
+        save_results()
+
+        # Final output save (atomic) + integrity check
+        sync_results()
+        rotate_and_save(df, output_csv)
+        print(f"Saved final output to {output_csv} | rows={len(df):,} | filled={np.count_nonzero(pred_codes >= 0):,}")
+
+        # Optional on-disk verification (catch truncation)
+        _ver = pd.read_csv(output_csv, nrows=5)  # light read just to ensure readable
+        if len(df) != total_rows:
+            print(f"WARNING: in-memory rows {len(df)} != input rows {total_rows}")
+        assert len(df) == total_rows, f"Row count changed in memory: {len(df)} vs {total_rows}"
+
+    except Exception as e:
+        # Save something if we crash unexpectedly
+        print(f"Exception: {e}. Saving results…")
+        try:
+            save_results()
+        except Exception as ee:
+            print(f"Failed to save results: {ee}")
+        raise
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    # e.g. python 2_detect_tents_v3.py 3 4 5: the chunks run one after another in this
+    # interpreter, sharing the loaded model instead of paying the Torch/CUDA start-up per chunk
+    for chunk_id in map(int, sys.argv[1:]):
+        process_chunk(chunk_id)
+        if shutdown_flag.is_set():
+            break